@@ -1,12 +1,34 @@
 #!/usr/bin/python
-from flask import Flask, request, json
+from flask import Flask, request, json, abort
+from flask.json.provider import JSONProvider
 from werkzeug.exceptions import HTTPException
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget
+from urllib3.util.retry import Retry
+import orjson
+from datetime import timedelta
+import io
 import os.path
-import string
-import random
+import threading
+import time
+import secrets
+
+class OrjsonProvider(JSONProvider):
+    """Serializes responses with orjson, keys sorted like Flask's default provider."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 BUCKET = os.getenv('GCP_BUCKET')
 CREDENTIALS_PATH = os.getenv('GCP_CREDENTIALS_PATH')
@@ -21,56 +43,109 @@ if os.getenv('UPROXY_PORT'):
     PORT = os.getenv('UPROXY_PORT')
 else:
     PORT = '8000'
+if os.getenv('UPROXY_SIGNED_URL_TTL'):
+    SIGNED_URL_TTL = timedelta(seconds=int(os.getenv('UPROXY_SIGNED_URL_TTL')))
+    # v4 signed URLs can't be valid for more than seven days
+    if not timedelta(seconds=1) <= SIGNED_URL_TTL <= timedelta(days=7):
+        raise ValueError('UPROXY_SIGNED_URL_TTL must be between 1 and 604800 seconds')
+else:
+    SIGNED_URL_TTL = None
+# For buckets with fine-grained ACLs the object is created public in the
+# same request that uploads it
+if os.getenv('UPROXY_PUBLIC_ACL'):
+    PREDEFINED_ACL = 'publicRead'
+else:
+    PREDEFINED_ACL = None
 if os.getenv('UPROXY_MAX_FILESIZE'):
-    app.config['MAX_CONTENT_LENGTH'] = os.getenv('UPROXY_MAX_FILESIZE') * 1024 * 1024
+    app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('UPROXY_MAX_FILESIZE')) * 1024 * 1024
+
+# Resumable uploads need a multiple of 256 KiB
+CHUNK_SIZE = 8 * 1024 * 1024
+# GCS starts answering with 5xx and rate limits when too many uploads
+# run at once, so extra uploads wait for a free slot instead
+if os.getenv('UPROXY_MAX_CONCURRENT_UPLOADS'):
+    MAX_CONCURRENT_UPLOADS = int(os.getenv('UPROXY_MAX_CONCURRENT_UPLOADS'))
+else:
+    MAX_CONCURRENT_UPLOADS = 15
+UPLOAD_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_UPLOADS)
 
 print(BUCKET)
 print(CREDENTIALS_PATH)
 print(HOST)
 print(PORT)
 
+CREDENTIALS = service_account.Credentials.from_service_account_file(CREDENTIALS_PATH, scopes=storage.Client.SCOPE)
+# The default pool keeps 10 connections, fewer than gevent serves at once,
+# so extra connections were dropped and re-handshaked on every upload
+SESSION = AuthorizedSession(CREDENTIALS)
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=64,
+    pool_maxsize=64,
+    # Only failed connects are retried here, the storage library has its
+    # own retry policy for requests that reached GCS
+    max_retries=Retry(connect=3, read=0, status=0, backoff_factor=0.1),
+))
+CLIENT = storage.Client(project=CREDENTIALS.project_id, credentials=CREDENTIALS, _http=SESSION)
+GCS_BUCKET = CLIENT.bucket(BUCKET)
+
+@app.before_request
+def check_content_length():
+    # Reject by the declared size before any of the body is read
+    max_length = app.config['MAX_CONTENT_LENGTH']
+    if max_length is not None and request.content_length is not None and request.content_length > max_length:
+        abort(413)
+
 @app.route('/upload', methods = ['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
-        f = request.files['file']
-        f.save(f.filename)
-        client = storage.Client.from_service_account_json(json_credentials_path=CREDENTIALS_PATH)
-        bucket = client.get_bucket(BUCKET)
-        split_name = os.path.splitext(f.filename)
-        if "ALLOWED_FILES" in globals() and (split_name[1] not in ALLOWED_FILES):
-            response = app.response_class(
-                response=json.dumps({
-                    "code": 400,
-                    "name": "Bad Request",
-                    "description": "Incorrect file",
-                }),
-                status=400,
-                mimetype='application/json'
-            )
-            return response
+        # The body is parsed as it is read and the file part is piped into a
+        # resumable upload, so receiving from the client and sending to GCS
+        # overlap instead of spooling the whole file first.
+        # A body that fits in one chunk is sent as a single multipart upload,
+        # a resumable session would cost an extra round trip to open it
+        small_body = request.content_length is not None and request.content_length <= CHUNK_SIZE
+        try:
+            parser = StreamingFormDataParser(headers=request.headers)
+        except ParseFailedException:
+            abort(400)
+        target = GCSTarget(small_body)
+        parser.register('file', target)
+
+        try:
+            while True:
+                chunk = request.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.data_received(chunk)
+        except ParseFailedException:
+            abort(400)
+        finally:
+            # A part that didn't reach its closing boundary must not be
+            # committed when the writer is garbage-collected
+            target.discard()
 
-        filename = id_generator()+split_name[1]
-        object_name_in_gcs_bucket = bucket.blob(filename)
-        print(f.read())
-        f.seek(0)
-        object_name_in_gcs_bucket.upload_from_string(f.stream.read())
-        object_name_in_gcs_bucket.make_public()
+        if not target.uploaded:
+            abort(400)
+        object_name_in_gcs_bucket = target.blob
+
+        # Objects are readable through the bucket's IAM policy, signing is
+        # done locally with the service account key so neither needs an RPC
+        if SIGNED_URL_TTL:
+            url = object_name_in_gcs_bucket.generate_signed_url(expiration=SIGNED_URL_TTL, version='v4')
+        else:
+            url = object_name_in_gcs_bucket.public_url
 
         response = app.response_class(
             response=json.dumps({
                 "code": 200,
                 "name": "Success",
-                "description": object_name_in_gcs_bucket.public_url,
+                "description": url,
             }),
             status=200,
             mimetype='application/json'
         )
         return response
 
-@app.errorhandler(413)
-def error413(e):
-    return print("Big file"), 413
-
 @app.errorhandler(HTTPException)
 def handle_exception(e):
     response = e.get_response()
@@ -83,8 +158,87 @@ def handle_exception(e):
     response.content_type = "application/json"
     return response
 
-def id_generator(size=24, chars=string.ascii_lowercase + string.ascii_uppercase + string.digits):
-    return ''.join(random.choice(chars) for _ in range(size))
+class GCSTarget(BaseTarget):
+    """Writes the file part into a new GCS object while the parser produces it."""
+
+    def __init__(self, small_body):
+        super().__init__()
+        self.small_body = small_body
+        self.blob = None
+        self.uploaded = False
+        self._skip_part = False
+        self._buffer = None
+        self._writer = None
+
+    def on_start(self):
+        # Only the first file part is uploaded, like request.files['file']
+        if self.blob is not None:
+            self._skip_part = True
+            return
+
+        extension = os.path.splitext(self.multipart_filename or '')[1]
+        if "ALLOWED_FILES" in globals() and (extension not in ALLOWED_FILES):
+            abort(400, description="Incorrect file")
+
+        # Date prefix keeps objects listable by day with list_blobs(prefix=...)
+        filename = time.strftime('%Y/%m/%d', time.gmtime())+'/'+id_generator(16)+extension
+        self.blob = GCS_BUCKET.blob(filename)
+        self._buffer = io.BytesIO() if self.small_body else None
+        self._writer = None
+
+    def on_data_received(self, chunk):
+        if self._skip_part:
+            return
+        if self._buffer is not None:
+            self._buffer.write(chunk)
+            return
+        if self._writer is None:
+            # The part's Content-Type is only known once its body starts
+            self._writer = self.blob.open(
+                'wb',
+                chunk_size=CHUNK_SIZE,
+                content_type=self.multipart_content_type,
+                predefined_acl=PREDEFINED_ACL,
+            )
+        # The writer only talks to GCS once a full chunk is buffered, so an
+        # upload slot is held for those writes and not while the client is
+        # still sending the rest of the chunk
+        if self._writer.tell() % CHUNK_SIZE + len(chunk) >= CHUNK_SIZE:
+            with UPLOAD_SLOTS:
+                self._writer.write(chunk)
+        else:
+            self._writer.write(chunk)
+
+    def on_finish(self):
+        if self._skip_part:
+            self._skip_part = False
+            return
+        if self._writer is not None:
+            with UPLOAD_SLOTS:
+                self._writer.close()
+        else:
+            # The body was buffered outside the cap, only the single
+            # request to GCS needs a slot
+            buffer = self._buffer or io.BytesIO()
+            with UPLOAD_SLOTS:
+                self.blob.upload_from_file(
+                    buffer,
+                    size=buffer.tell(),
+                    content_type=self.multipart_content_type,
+                    predefined_acl=PREDEFINED_ACL,
+                    rewind=True,
+                )
+        self.uploaded = True
+
+    def discard(self):
+        """Cancels the resumable upload of a part that wasn't finished."""
+        if self._writer is not None and not self.uploaded:
+            with UPLOAD_SLOTS:
+                self._writer.terminate()
+            self._writer = None
+
+def id_generator(size=24):
+    return secrets.token_urlsafe(size)[:size]
 
 if __name__ == '__main__':
     app.run(host=HOST, port=PORT, debug = False)